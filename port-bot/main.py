@@ -1,14 +1,17 @@
 from openai import OpenAI
 import random
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 from typing import List, Optional, Union
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import supabase
 import json
 import os
 from dotenv import load_dotenv
 import re
+import math
+import time
+import uuid
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -625,6 +628,17 @@ def generate_random_task_for_employee(employee_id: str):
     # Fetch the list of employees (for partner tasks)
     employee_list = fetch_employees_from_supabase()
 
+    task = generate_random_task(employee, employee_list)
+
+    # Return the generated task
+    return {"generated_task": task}
+
+
+def generate_random_task(employee: Employee, employee_list: List[Employee]) -> Task:
+    """
+    Generates a task of a random type for the employee and saves it to Supabase.
+    Partners are chosen from employee_list, excluding the employee themselves.
+    """
     # Exclude the current employee from potential partners
     potential_partners = [
         emp for emp in employee_list if emp.user_id != employee.user_id]
@@ -656,5 +670,388 @@ def generate_random_task_for_employee(employee_id: str):
     # Save the generated task to Supabase
     save_task_to_supabase(task)
 
-    # Return the generated task
-    return {"generated_task": task}
+    return task
+
+### Staggered Task Generation Scheduler ###
+
+# The scheduler keeps its shared state in the scheduler_locks and scheduler_failures
+# Supabase tables so that every gunicorn worker sees the same lease and failure
+# history. Create them with scheduler_tables.sql before enabling the scheduler.
+
+# LLM requests per minute the scheduler is allowed to spend on replacement tasks
+SCHEDULER_RPM_BUDGET = int(os.getenv("SCHEDULER_RPM_BUDGET", "3"))
+# Length of a scheduling bucket; /scheduler/tick should be called once per bucket
+SCHEDULER_BUCKET_MINUTES = int(os.getenv("SCHEDULER_BUCKET_MINUTES", "15"))
+# Open tasks due within this many hours are treated as about to expire, and a
+# stale task should be replaced within this many hours of going stale
+SCHEDULER_LOOKAHEAD_HOURS = int(os.getenv("SCHEDULER_LOOKAHEAD_HOURS", "12"))
+# Completed or expired tasks older than this are no longer replaced
+SCHEDULER_HISTORY_DAYS = int(os.getenv("SCHEDULER_HISTORY_DAYS", "7"))
+# Employees whose generation failed are skipped for this long, doubling per failure
+SCHEDULER_FAILURE_BACKOFF_MINUTES = int(os.getenv("SCHEDULER_FAILURE_BACKOFF_MINUTES", "60"))
+
+if SCHEDULER_RPM_BUDGET < 1 or SCHEDULER_BUCKET_MINUTES < 1:
+    raise ValueError("SCHEDULER_RPM_BUDGET and SCHEDULER_BUCKET_MINUTES must be at least 1")
+# An easy task is due by the end of the next day, so it has at least 24 hours left when
+# created. A longer lookahead would make every new task stale immediately.
+if not 0 < SCHEDULER_LOOKAHEAD_HOURS < 24:
+    raise ValueError("SCHEDULER_LOOKAHEAD_HOURS must be between 1 and 23")
+
+# Worst case for a random task: one partner match plus one task generation
+LLM_CALLS_PER_GENERATION = 2
+# Seconds between the starts of two generations, shared by all workers
+GENERATION_INTERVAL_SECONDS = 60 * LLM_CALLS_PER_GENERATION / SCHEDULER_RPM_BUDGET
+# Extra lease time covering LLM latency, after which a crashed batch's lease expires
+LEASE_MARGIN_SECONDS = 300
+MAX_FAILURE_BACKOFF = timedelta(days=1)
+SUPABASE_PAGE_SIZE = 1000
+SCHEDULER_LOCK_NAME = "task_generation"
+
+
+class ScheduledGeneration(BaseModel):
+    user_id: str
+    reason: str  # completed or expiring, for the oldest unreplaced task
+    stale_since: str  # When the oldest unreplaced task completed or entered the lookahead window
+    latest_stale_at: str  # Same for the newest unreplaced task
+    replace_by: str  # stale_since plus the lookahead window
+    stale_task_count: int  # One replacement task is generated for each
+
+
+def parse_task_datetime(value: Optional[str]) -> Optional[datetime]:
+    """Parse a date or timestamp from the tasks table into a naive local datetime."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def parse_due_by(value: Optional[str]) -> Optional[datetime]:
+    """A date-only due_by means the task can be done until the end of that day."""
+    due_by = parse_task_datetime(value)
+    if due_by and len(value) == 10:
+        due_by += timedelta(days=1)
+    return due_by
+
+
+def fetch_all_rows(build_query) -> List[dict]:
+    """Page through a Supabase query so results are not cut off at the API row limit."""
+    rows = []
+    start = 0
+    while True:
+        response = build_query().range(start, start + SUPABASE_PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < SUPABASE_PAGE_SIZE:
+            return rows
+        start += SUPABASE_PAGE_SIZE
+
+
+def fetch_stale_task_candidates(now: datetime) -> List[dict]:
+    """
+    Fetches open tasks that are due within the lookahead window and tasks completed
+    within the history window. Both are limited to the last SCHEDULER_HISTORY_DAYS.
+    """
+    columns = "task_id, user_id, due_by, completed, completed_at, created_at"
+    cutoff = now - timedelta(days=SCHEDULER_HISTORY_DAYS)
+    due_limit = now + timedelta(hours=SCHEDULER_LOOKAHEAD_HOURS)
+    try:
+        open_tasks = fetch_all_rows(lambda: supabase_client.table("tasks").select(columns)
+                                    .eq("completed", False)
+                                    .gte("due_by", cutoff.strftime('%Y-%m-%d'))
+                                    .lte("due_by", due_limit.strftime('%Y-%m-%d'))
+                                    .order("task_id"))
+        completed_tasks = fetch_all_rows(lambda: supabase_client.table("tasks").select(columns)
+                                         .eq("completed", True)
+                                         .gte("completed_at", cutoff.strftime('%Y-%m-%d %H:%M:%S'))
+                                         .order("task_id"))
+        return open_tasks + completed_tasks
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error fetching tasks from Supabase: {str(e)}")
+
+
+def fetch_recent_task_creations(user_ids: List[str], since: datetime) -> List[dict]:
+    """Fetches the creation times of tasks the given employees received since the cutoff."""
+    if not user_ids:
+        return []
+    try:
+        return fetch_all_rows(lambda: supabase_client.table("tasks").select("task_id, user_id, created_at")
+                              .in_("user_id", user_ids)
+                              .gte("created_at", since.strftime('%Y-%m-%d %H:%M:%S'))
+                              .order("task_id"))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error fetching tasks from Supabase: {str(e)}")
+
+
+def fetch_backed_off_employees(now: datetime) -> set:
+    """Returns the employees whose last generation failed too recently to retry."""
+    try:
+        response = supabase_client.table("scheduler_failures").select("*").execute()
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error fetching scheduler failures from Supabase: {str(e)}")
+
+    backed_off = set()
+    for failure in response.data or []:
+        failed_at = parse_task_datetime(failure["failed_at"])
+        backoff = timedelta(minutes=SCHEDULER_FAILURE_BACKOFF_MINUTES) * 2 ** (failure["failure_count"] - 1)
+        if failed_at and failed_at + min(backoff, MAX_FAILURE_BACKOFF) > now:
+            backed_off.add(failure["user_id"])
+    return backed_off
+
+
+def find_unreplaced_events(now: datetime) -> dict:
+    """
+    Finds tasks that completed or entered the lookahead window, per employee, and
+    pairs each with a newer task of that employee in order. Tasks left without a
+    newer task still need a replacement and are returned as (stale_at, reason).
+    """
+    lookahead = timedelta(hours=SCHEDULER_LOOKAHEAD_HOURS)
+    stale_events = {}
+
+    for task in fetch_stale_task_candidates(now):
+        created_at = parse_task_datetime(task.get("created_at"))
+        if task.get("completed"):
+            stale_at = parse_task_datetime(task.get("completed_at"))
+            reason = "completed"
+        else:
+            due_by = parse_due_by(task.get("due_by"))
+            stale_at = due_by - lookahead if due_by else None
+            reason = "expiring"
+
+        if not stale_at or stale_at > now:
+            continue
+        # A task never counts as its own replacement
+        if created_at and created_at > stale_at:
+            stale_at = created_at
+        stale_events.setdefault(task["user_id"], []).append((stale_at, reason))
+
+    if not stale_events:
+        return {}
+
+    earliest_event = min(event[0] for events in stale_events.values() for event in events)
+    creations = {}
+    for task in fetch_recent_task_creations(list(stale_events), earliest_event):
+        created_at = parse_task_datetime(task.get("created_at"))
+        if created_at:
+            creations.setdefault(task["user_id"], []).append(created_at)
+
+    unreplaced = {}
+    for user_id, events in stale_events.items():
+        events.sort()
+        replacements = sorted(creations.get(user_id, []))
+        remaining = []
+        next_replacement = 0
+        for event in events:
+            # Use the oldest task created strictly after this event as its replacement
+            while next_replacement < len(replacements) and replacements[next_replacement] <= event[0]:
+                next_replacement += 1
+            if next_replacement < len(replacements):
+                next_replacement += 1
+            else:
+                remaining.append(event)
+        if remaining:
+            unreplaced[user_id] = remaining
+    return unreplaced
+
+
+def build_generation_backlog(unreplaced: dict) -> List[ScheduledGeneration]:
+    """Employees waiting for replacement tasks. Oldest staleness is served first."""
+    lookahead = timedelta(hours=SCHEDULER_LOOKAHEAD_HOURS)
+
+    backlog = []
+    for user_id, events in unreplaced.items():
+        stale_since, reason = events[0]
+        backlog.append(ScheduledGeneration(
+            user_id=user_id,
+            reason=reason,
+            stale_since=stale_since.strftime('%Y-%m-%d %H:%M:%S'),
+            latest_stale_at=events[-1][0].strftime('%Y-%m-%d %H:%M:%S'),
+            replace_by=(stale_since + lookahead).strftime('%Y-%m-%d %H:%M:%S'),
+            stale_task_count=len(events)
+        ))
+
+    backlog.sort(key=lambda entry: entry.stale_since)
+    return backlog
+
+
+def bucket_capacity() -> int:
+    """Generations that fit into one bucket under the RPM budget."""
+    return max(SCHEDULER_RPM_BUDGET * SCHEDULER_BUCKET_MINUTES // LLM_CALLS_PER_GENERATION, 1)
+
+
+def bucket_quota(deadlines: List[datetime], now: datetime) -> int:
+    """
+    The lowest steady per-bucket rate that replaces every stale task by its
+    deadline, capped by the RPM budget. Overdue tasks ask for the full capacity.
+    """
+    bucket = timedelta(minutes=SCHEDULER_BUCKET_MINUTES)
+    quota = 0
+    for rank, deadline in enumerate(sorted(deadlines), start=1):
+        buckets_left = max(math.ceil((deadline - now) / bucket), 1)
+        quota = max(quota, math.ceil(rank / buckets_left))
+    return min(bucket_capacity(), quota)
+
+
+def _utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def acquire_scheduler_lease(holder: str, batch_size: int) -> bool:
+    """
+    Takes the shared scheduler lease if no other batch holds it and the previous
+    batch's rate limit has passed. The conditional update is atomic in Postgres.
+    """
+    now = _utc_now()
+    locked_until = now + timedelta(seconds=batch_size * GENERATION_INTERVAL_SECONDS + LEASE_MARGIN_SECONDS)
+    try:
+        # Make sure the lock row exists without touching an existing lease
+        supabase_client.table("scheduler_locks").upsert(
+            {"name": SCHEDULER_LOCK_NAME, "holder": None, "locked_until": now.isoformat()},
+            on_conflict="name", ignore_duplicates=True).execute()
+        response = supabase_client.table("scheduler_locks").update(
+            {"holder": holder, "locked_until": locked_until.isoformat()}
+        ).eq("name", SCHEDULER_LOCK_NAME).lte("locked_until", now.isoformat()).execute()
+        return bool(response.data)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error acquiring scheduler lease: {str(e)}")
+
+
+def update_scheduler_lease(holder: str, locked_until: datetime) -> bool:
+    """Moves the lease expiry if this holder still owns it."""
+    response = supabase_client.table("scheduler_locks").update(
+        {"locked_until": locked_until.isoformat()}
+    ).eq("name", SCHEDULER_LOCK_NAME).eq("holder", holder).execute()
+    return bool(response.data)
+
+
+def fetch_scheduler_lease() -> Optional[dict]:
+    response = supabase_client.table("scheduler_locks").select("*").eq(
+        "name", SCHEDULER_LOCK_NAME).execute()
+    return response.data[0] if response.data else None
+
+
+def record_generation_failure(user_id: str) -> None:
+    response = supabase_client.table("scheduler_failures").select(
+        "failure_count").eq("user_id", user_id).execute()
+    failure_count = response.data[0]["failure_count"] + 1 if response.data else 1
+    supabase_client.table("scheduler_failures").upsert({
+        "user_id": user_id,
+        "failed_at": _utc_now().isoformat(),
+        "failure_count": failure_count
+    }, on_conflict="user_id").execute()
+
+
+def clear_generation_failure(user_id: str) -> None:
+    supabase_client.table("scheduler_failures").delete().eq("user_id", user_id).execute()
+
+
+def run_scheduled_generations(user_ids: List[str], holder: str) -> None:
+    """
+    Generates one replacement task per entry in user_ids while holding the scheduler lease.
+    Generations start GENERATION_INTERVAL_SECONDS apart, and the lease is released
+    no earlier than the next allowed start, so the RPM budget holds across batches.
+    """
+    batch_start = time.monotonic()
+    next_allowed = _utc_now()
+    try:
+        employee_list = fetch_employees_from_supabase()
+        employees_by_id = {emp.user_id: emp for emp in employee_list}
+
+        for index, user_id in enumerate(user_ids):
+            # Start on a fixed grid so LLM latency does not stretch the batch
+            delay = batch_start + index * GENERATION_INTERVAL_SECONDS - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            next_allowed = _utc_now() + timedelta(seconds=GENERATION_INTERVAL_SECONDS)
+            if not update_scheduler_lease(holder, next_allowed + timedelta(seconds=LEASE_MARGIN_SECONDS)):
+                print("Scheduler lease lost, stopping batch")
+                return
+
+            employee = employees_by_id.get(user_id)
+            if not employee:
+                print(f"Scheduler skipped unknown employee {user_id}")
+                continue
+
+            try:
+                generate_random_task(employee, employee_list)
+                clear_generation_failure(user_id)
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                print(f"Scheduler failed to generate task for {user_id}: {detail}")
+                try:
+                    record_generation_failure(user_id)
+                except Exception as record_error:
+                    print(f"Scheduler failed to record failure for {user_id}: {record_error}")
+    except Exception as e:
+        print(f"Scheduler batch aborted: {e}")
+    finally:
+        try:
+            update_scheduler_lease(holder, max(next_allowed, _utc_now()))
+        except Exception as e:
+            print(f"Scheduler failed to release lease: {e}")
+
+
+def plan_scheduler_bucket(now: datetime) -> dict:
+    backed_off = fetch_backed_off_employees(now)
+    unreplaced = {user_id: events for user_id, events in find_unreplaced_events(now).items()
+                  if user_id not in backed_off}
+    backlog = build_generation_backlog(unreplaced)
+    lookahead = timedelta(hours=SCHEDULER_LOOKAHEAD_HOURS)
+
+    # One generation per stale task, each due by its own stale time plus the lookahead
+    generations = sorted((stale_at, user_id)
+                         for user_id, events in unreplaced.items() for stale_at, _ in events)
+    quota = bucket_quota([stale_at + lookahead for stale_at, _ in generations], now)
+
+    return {
+        "rpm_budget": SCHEDULER_RPM_BUDGET,
+        "bucket_minutes": SCHEDULER_BUCKET_MINUTES,
+        "lookahead_hours": SCHEDULER_LOOKAHEAD_HOURS,
+        "bucket_capacity": bucket_capacity(),
+        "bucket_quota": quota,
+        "pending_generations": len(generations),
+        "backlog": backlog,
+        "scheduled": [user_id for _, user_id in generations[:quota]]
+    }
+
+
+@app.get("/scheduler/backlog")
+def get_scheduler_backlog():
+    """Shows the employees waiting for a replacement task and what the current bucket would take."""
+    plan = plan_scheduler_bucket(datetime.now())
+    try:
+        lease = fetch_scheduler_lease()
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"Error fetching scheduler lease: {str(e)}")
+    return {"lease": lease, **plan}
+
+
+@app.post("/scheduler/tick")
+def run_scheduler_tick(background_tasks: BackgroundTasks, dry_run: bool = False):
+    """
+    Queues replacement generation for the current bucket's share of the backlog.
+    Meant to be called by a cron job every SCHEDULER_BUCKET_MINUTES; ticks that
+    arrive while another batch holds the lease are skipped.
+    With dry_run the plan is returned without generating anything.
+    """
+    plan = plan_scheduler_bucket(datetime.now())
+    user_ids = plan["scheduled"]
+
+    started = False
+    if not dry_run and user_ids:
+        holder = str(uuid.uuid4())
+        started = acquire_scheduler_lease(holder, len(user_ids))
+        if started:
+            background_tasks.add_task(run_scheduled_generations, user_ids, holder)
+
+    return {"dry_run": dry_run, "started": started, **plan}
@@ -0,0 +1,16 @@
+-- Shared state for the staggered task generation scheduler (/scheduler/* in main.py).
+-- Run once in the Supabase SQL editor before calling the scheduler endpoints.
+
+-- One row per lease; the scheduler creates its 'task_generation' row on first use
+create table if not exists scheduler_locks (
+    name text primary key,
+    holder text,
+    locked_until timestamptz not null default now()
+);
+
+-- Employees whose last scheduled generation failed, used for retry backoff
+create table if not exists scheduler_failures (
+    user_id uuid primary key,
+    failed_at timestamptz not null default now(),
+    failure_count integer not null default 1
+);